@@ -1,13 +1,30 @@
 import os
-import json
 import time
 import asyncio
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from collections import OrderedDict, deque
 import anthropic
+import orjson
 import notion_client as notion
 
+logger = logging.getLogger(__name__)
+
 MODEL = "claude-sonnet-4-6"
+LOOKUP_MODEL = "claude-haiku-4-5"  # cheaper, faster model for read-only lookups
+SUMMARY_MODEL = "claude-haiku-4-5"  # cheap model for compressing old history
 CONVERSATION_TTL = 30 * 60  # 30 minutes — conversations expire after this
-MAX_HISTORY = 20  # max message pairs to keep per conversation
+MAX_HISTORY = 50  # hard cap on messages per conversation (backstop for compression)
+COMPRESS_THRESHOLD = 4000  # estimated history tokens before older turns are summarized
+KEEP_RECENT_GROUPS = 5  # message groups always kept verbatim at the end of history
+MAX_SENDERS = 10_000  # max conversations held in memory (LRU-evicted)
+SWEEP_INTERVAL = 60  # seconds between expired-conversation sweeps
+
+# Shared client so the connection pool (and TLS session) to api.anthropic.com
+# is reused across messages instead of rebuilt on every webhook.
+_CLIENT = anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY", "").strip())
 
 SYSTEM_PROMPT = """You are the inventory assistant for Flame & Finish Marketing Corp,
 an import business in Cebu, Philippines that sells SPC flooring and WPC wall panels.
@@ -23,7 +40,7 @@ Rules:
 - Reply in concise, friendly English by default.
 - Understand and accept messages in Cebuano, Tagalog, or English — but always respond in English.
 - Always show the peso sign (₱) for prices.
-- When processing a sale: (1) lookup the product, (2) update stock, (3) log the sale. Always do all three steps.
+- When processing a sale: (1) lookup the product, (2) call record_sale, which updates stock and logs the sale in one step. Only use update_stock and log_sale separately for corrections or when one half of record_sale failed.
 - When updating stock after a sale, confirm the old stock, the deduction, and the new stock.
 - If a product isn't found, say so clearly and ask for clarification.
 - Keep replies short — this is WhatsApp, not email.
@@ -80,7 +97,7 @@ When a user asks about pricing (e.g. "how much should I sell SPC floor?", "what'
 - If any pricing field is not available for a product, omit that line and note it's not set.
 - When listing multiple products, use the same format for each."""
 
-TOOLS = [
+TOOLS = (
     {
         "name": "lookup_products",
         "description": "Search the inventory database for products. Use a search term to filter by product name, or leave empty to get all products.",
@@ -170,48 +187,351 @@ TOOLS = [
             "required": ["product_name", "quantity", "unit_price", "sold_by"],
         },
     },
-]
+    {
+        "name": "record_sale",
+        "description": "Record a sale in one step: set the product's new stock AND log the sale to the Sales Log. Use this after looking up the product instead of calling update_stock and log_sale separately.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "page_id": {
+                    "type": "string",
+                    "description": "The Notion page ID of the product sold.",
+                },
+                "product_name": {
+                    "type": "string",
+                    "description": "The product name (e.g. 'Oak SPC Flooring').",
+                },
+                "new_stock": {
+                    "type": "integer",
+                    "description": "The stock quantity after deducting the sale.",
+                },
+                "quantity": {
+                    "type": "integer",
+                    "description": "Number of units sold.",
+                },
+                "unit_price": {
+                    "type": "number",
+                    "description": "Price per unit in Philippine Pesos.",
+                },
+                "sold_by": {
+                    "type": "string",
+                    "description": "Name or phone number of the salesperson who reported the sale.",
+                },
+            },
+            "required": ["page_id", "product_name", "new_stock", "quantity", "unit_price", "sold_by"],
+        },
+        # Cache breakpoint on the last tool covers the whole tools block.
+        "cache_control": {"type": "ephemeral"},
+    },
+)
+
+# System prompt as a cacheable block — it never changes between turns, so
+# Anthropic can serve the system + tools prefix from its prompt cache.
+SYSTEM_BLOCKS = (
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+)
+
+# Tools and system blocks are built once at import and shared by every
+# request as immutable tuples. Serializing them here makes a malformed
+# schema fail at startup instead of on the first message.
+orjson.dumps(TOOLS)
+orjson.dumps(SYSTEM_BLOCKS)
+
+# Canned replies for pure greetings/thanks — answered without calling Claude.
+# Keys are lowercased with trailing punctuation stripped.
+_FAST_REPLIES = {
+    "hi": "Hi! What product do you need?",
+    "hello": "Hello! What product do you need?",
+    "hey": "Hi! What product do you need?",
+    "good morning": "Good morning! What product do you need?",
+    "good afternoon": "Good afternoon! What product do you need?",
+    "good evening": "Good evening! What product do you need?",
+    "thanks": "You're welcome!",
+    "thank you": "You're welcome!",
+    "ty": "You're welcome!",
+    "salamat": "You're welcome!",
+}
+
+# Acks only get the canned reply when they can't be an answer — i.e. the bot's
+# last message wasn't a question like "Shall I record 5 boxes of Oak?".
+_ACK_REPLIES = {
+    "ok": "👍",
+    "okay": "👍",
+    "noted": "👍",
+    "sige": "👍",
+}
+
+# Intent routing: a message is a lookup only if it has a stock/price keyword,
+# no write verb (sell, sale, update, change, set, add, deduct, take, ...) and
+# no number right after a stock/price keyword ("oak stock is now 45"). It is
+# a keyword heuristic, so it errs towards MODEL; the write tools stay
+# available either way.
+_LOOKUP_RE = re.compile(r"\b(stock|how many|price|may|pila|pilay|magkano|presyo)\b", re.IGNORECASE)
+_WRITE_RE = re.compile(
+    r"\b(sell|sells|selling|sold|sale|sales|record|log|update|updated|change|changed"
+    r"|set|add|added|deduct|deducted|minus"
+    r"|new|now|benta|ibenta|nabenta|nagbenta|baligya|nabaligya|gibaligya|bawas|ibawas"
+    r"|kuha|gikuha|kinuha|nakuha|ilisi|usba|palitan)\b",
+    re.IGNORECASE,
+)
+# A stock/price keyword followed closely by a number reads as a new value.
+_ASSIGN_RE = re.compile(r"\b(stock|price|presyo)\b[^\d?]{0,20}\d", re.IGNORECASE)
+
+
+def _classify(user_message: str) -> str:
+    """Classify a message as "lookup" or "other" with a keyword heuristic."""
+    if (
+        _LOOKUP_RE.search(user_message)
+        and not _WRITE_RE.search(user_message)
+        and not _ASSIGN_RE.search(user_message)
+    ):
+        return "lookup"
+    return "other"
+
+
+# Simple stock questions ("stock of oak?", "how many walnut", "oak stock")
+# are answered straight from Notion without any LLM call.
+_STOCK_QUERY_RE = re.compile(
+    r"^(?:(?:stock\s+(?:of|for)|how\s+many)\s+(?P<term>[\w\s\-/()]+?)"
+    r"(?:\s+(?:left|in\s+stock|do\s+we\s+have))?"
+    r"|(?P<term_before>[\w\s\-/()]+?)\s+stock)\s*\??$",
+    re.IGNORECASE,
+)
+
+
+# Terms that must go to the model instead: generic words ("low stock", "all
+# stock") that aren't product names, and alias-map/category keywords, which
+# map to categories or item groups rather than a Product Name substring.
+_NOT_A_PRODUCT_RE = re.compile(
+    r"\b(low|all|total|current|remaining|available|overall|the|any|our|every|full|much|many"
+    r"|inventory|products?|items?|what|which|naa|ba"
+    r"|spc|wpc|wall|panels?|floor|flooring|reducers?|skirting|t-?\s?moulding|grilles|fluted|solid|small"
+    r"|arch|high|outdoor|decking|keel|flexible|flex|tiles?|uv|pvc|sound|acoustic|bamboo|charcoal|boards?)\b",
+    re.IGNORECASE,
+)
+
+
+def _extract_stock_term(user_message: str) -> str | None:
+    """Return the product keyword from a simple stock question, if it is one."""
+    match = _STOCK_QUERY_RE.match(user_message.strip())
+    if not match:
+        return None
+    term = (match.group("term") or match.group("term_before")).strip()
+    if not term or _NOT_A_PRODUCT_RE.search(term):
+        return None
+    return term
+
+
+def _names_match(products: list[dict], term: str) -> bool:
+    """True if every product name contains the term as a whole word."""
+    pattern = re.compile(rf"\b{re.escape(term)}\b", re.IGNORECASE)
+    return all(pattern.search(p["name"]) for p in products)
+
+
+def _format_stock(products: list[dict]) -> str:
+    """Format lookup results as a short WhatsApp stock list."""
+    lines = []
+    for p in products:
+        line = f"{p['name']}: {p['stock'] if p['stock'] is not None else '?'} {p['unit']}".rstrip()
+        if p["price"] is not None:
+            line += f" @ ₱{p['price']:,.2f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+# Message roles are stored as small ints; _ROLES maps them back for the API.
+_ROLES = ("user", "assistant")
+_ROLE_IDS = {role: i for i, role in enumerate(_ROLES)}
+
+
+@dataclass
+class Convo:
+    """One sender's history, stored as parallel role/content ring buffers.
+
+    Both deques share the MAX_HISTORY bound, so appending past it drops the
+    oldest message from each in lockstep. The list-of-dicts form the API
+    wants is only materialized on demand by messages().
+    """
+
+    roles: deque = field(default_factory=lambda: deque(maxlen=MAX_HISTORY))
+    contents: deque = field(default_factory=lambda: deque(maxlen=MAX_HISTORY))
+    last_active: float = field(default_factory=time.time)
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def head(self) -> dict:
+        return {"role": _ROLES[self.roles[0]], "content": self.contents[0]}
+
+    def messages(self) -> list[dict]:
+        return [{"role": _ROLES[r], "content": c} for r, c in zip(self.roles, self.contents)]
+
+    def extend(self, msgs: list[dict]):
+        for msg in msgs:
+            self.roles.append(_ROLE_IDS[msg["role"]])
+            self.contents.append(msg["content"])
+
+    def popleft(self):
+        self.roles.popleft()
+        self.contents.popleft()
 
-# In-memory conversation store: {phone_number: {"messages": [...], "last_active": timestamp}}
-_conversations: dict[str, dict] = {}
+    def clear(self):
+        self.roles.clear()
+        self.contents.clear()
+
+
+# In-memory conversation store: {phone_number: Convo}
+# LRU-ordered — the least recently active sender is always first.
+_conversations: OrderedDict[str, Convo] = OrderedDict()
 
 # Per-sender locks to prevent concurrent processing of messages from the same user
 _sender_locks: dict[str, asyncio.Lock] = {}
 
 
-def _get_conversation(sender: str) -> list[dict]:
+def _get_conversation(sender: str) -> Convo:
     """Get or create conversation history for a sender. Expires after TTL."""
     now = time.time()
     convo = _conversations.get(sender)
 
-    if convo and (now - convo["last_active"]) < CONVERSATION_TTL:
-        return convo["messages"]
+    if convo and (now - convo.last_active) < CONVERSATION_TTL:
+        convo.last_active = now
+        _conversations.move_to_end(sender)
+        return convo
 
     # Expired or new — start fresh
-    _conversations[sender] = {"messages": [], "last_active": now}
-    return _conversations[sender]["messages"]
+    _conversations[sender] = Convo(last_active=now)
+    _conversations.move_to_end(sender)
+    while len(_conversations) > MAX_SENDERS:
+        evicted, _ = _conversations.popitem(last=False)
+        _drop_sender_lock(evicted)
+    return _conversations[sender]
+
+
+def _drop_sender_lock(sender: str):
+    """Forget an evicted sender's lock unless a message is still in flight."""
+    lock = _sender_locks.get(sender)
+    if lock and not lock.locked():
+        del _sender_locks[sender]
+
+
+async def sweep_conversations():
+    """Background task: periodically evict conversations idle past the TTL."""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        cutoff = time.time() - CONVERSATION_TTL
+        while _conversations and next(iter(_conversations.values())).last_active < cutoff:
+            evicted, _ = _conversations.popitem(last=False)
+            _drop_sender_lock(evicted)
+
+
+def _drop_orphans(convo: Convo):
+    """Drop leading messages the history bound may have cut from their pair."""
+    # Never start with an orphaned tool_result whose tool_use was dropped,
+    # and never start with an assistant message (Claude API requires
+    # conversations to start with a user message).
+    while convo and (convo.roles[0] == _ROLE_IDS["assistant"] or _is_tool_result_message(convo.head())):
+        convo.popleft()
 
 
-def _trim_conversation(sender: str):
-    """Keep conversation history within limits without breaking tool call pairs."""
-    convo = _conversations.get(sender)
-    if not convo:
+def _estimate_tokens(contents) -> int:
+    """Rough token count (~4 chars per token) — good enough for a threshold."""
+    return sum(len(str(content)) for content in contents) // 4
+
+
+def _group_starts(msgs) -> list[int]:
+    """Indices where each message group starts.
+
+    An assistant tool_use message and the tool_result message that answers
+    it form one group; every other message is a group on its own.
+    """
+    starts = []
+    for i, msg in enumerate(msgs):
+        if i > 0 and _is_tool_result_message(msg):
+            continue  # belongs to the preceding tool_use group
+        starts.append(i)
+    return starts
+
+
+async def _compress(history: Convo):
+    """Summarize the middle of a long conversation in place.
+
+    Keeps the first message and the last KEEP_RECENT_GROUPS groups verbatim
+    and replaces everything between them with a short assistant summary
+    written by SUMMARY_MODEL. Does nothing while the middle section is under
+    COMPRESS_THRESHOLD, so a large tool result in the kept tail doesn't
+    trigger a summary on every message. On failure history is left as-is
+    and the MAX_HISTORY bound takes over.
+    """
+    # Cheap early exit — the middle can't exceed the threshold if the whole does not.
+    if _estimate_tokens(history.contents) <= COMPRESS_THRESHOLD:
         return
-    msgs = convo["messages"]
-    # Trim from the front, but never leave an orphaned tool_result without
-    # its matching tool_use in the previous assistant message.
-    while len(msgs) > MAX_HISTORY:
-        msgs.pop(0)
-    # After trimming, ensure the first message isn't a tool_result (role=user
-    # with tool_result content).  If it is, keep popping until we reach a clean
-    # user text message.
-    while msgs and _is_tool_result_message(msgs[0]):
-        msgs.pop(0)
-    # Also ensure we don't start with an assistant message (Claude API requires
-    # conversations to start with a user message).
-    while msgs and msgs[0].get("role") == "assistant":
-        msgs.pop(0)
-    convo["last_active"] = time.time()
+
+    msgs = history.messages()
+    starts = _group_starts(msgs)
+    if len(starts) <= KEEP_RECENT_GROUPS + 1:
+        return
+
+    # The kept tail must open with a plain user message so roles keep
+    # alternating: first user message → summary (assistant) → tail.
+    tail = starts[-KEEP_RECENT_GROUPS]
+    while tail > 1 and (msgs[tail]["role"] != "user" or _is_tool_result_message(msgs[tail])):
+        tail -= 1
+    middle = msgs[1:tail]
+    if _estimate_tokens(msg["content"] for msg in middle) <= COMPRESS_THRESHOLD:
+        return
+
+    try:
+        response = await _CLIENT.messages.create(
+            model=SUMMARY_MODEL,
+            max_tokens=300,
+            system="Summarize this inventory-bot conversation excerpt in a few short lines. "
+                   "Keep product names, page IDs, stock numbers, prices and any pending sale.",
+            messages=[{"role": "user", "content": "\n".join(_render(m) for m in middle)}],
+        )
+    except Exception as e:
+        logger.warning(f"History compression failed: {e}")
+        return
+
+    summary = "".join(block.text for block in response.content if block.type == "text")
+    history.clear()
+    history.extend([
+        msgs[0],
+        {"role": "assistant", "content": f"[Summary of earlier conversation]\n{summary}"},
+        *msgs[tail:],
+    ])
+
+
+def _render(msg: dict) -> str:
+    """Flatten a stored message (text or content blocks) into plain text."""
+    content = msg["content"]
+    if isinstance(content, str):
+        return f"{msg['role']}: {content}"
+    parts = []
+    for block in content:
+        if isinstance(block, dict):  # tool_result we built ourselves
+            parts.append(f"tool result: {block.get('content', '')}")
+        elif block.type == "text":
+            parts.append(block.text)
+        elif block.type == "tool_use":
+            parts.append(f"called {block.name}({orjson.dumps(block.input).decode()})")
+    return f"{msg['role']}: " + " ".join(parts)
+
+
+def _awaiting_answer(history: Convo) -> bool:
+    """True if the bot's last message asked the user something."""
+    if not history or history.roles[-1] != _ROLE_IDS["assistant"]:
+        return False
+    content = history.contents[-1]
+    return isinstance(content, str) and "?" in content
+
+
+def _record_exchange(history: Convo, user_message: str, reply: str):
+    """Save a user message and a reply produced without the agentic loop."""
+    history.extend([
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": reply},
+    ])
+    _drop_orphans(history)
 
 
 def _is_tool_result_message(msg: dict) -> bool:
@@ -229,6 +549,10 @@ def _is_tool_result_message(msg: dict) -> bool:
 
 async def handle_message(user_message: str, sender: str = "default") -> str:
     """Process a WhatsApp message through Claude and return the response."""
+    # Normalize once (NFC/NFD variants, full-width forms) so keyword matching,
+    # fast replies, history and the API call all see the same text.
+    user_message = unicodedata.normalize("NFKC", user_message)
+
     # Serialize messages per sender so concurrent webhooks don't corrupt history
     if sender not in _sender_locks:
         _sender_locks[sender] = asyncio.Lock()
@@ -238,57 +562,88 @@ async def handle_message(user_message: str, sender: str = "default") -> str:
 
 async def _handle_message_inner(user_message: str, sender: str) -> str:
     """Inner handler — runs under per-sender lock."""
-    client = anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY", "").strip())
-
-    messages = _get_conversation(sender)
+    history = _get_conversation(sender)
+
+    # Greetings and acks don't need the model — reply instantly, but still
+    # record the exchange so Claude has the context on the next real turn.
+    key = user_message.strip().lower().rstrip("!.?")
+    fast_reply = _FAST_REPLIES.get(key)
+    if not fast_reply and not _awaiting_answer(history):
+        fast_reply = _ACK_REPLIES.get(key)
+    if fast_reply:
+        _record_exchange(history, user_message, fast_reply)
+        return fast_reply
+
+    intent = _classify(user_message)
+
+    # Simple stock questions about a specific product skip the agentic loop:
+    # query Notion directly and format the answer in Python. Generic or alias
+    # terms, no results, partial/substring matches and Notion errors all fall
+    # through to Claude, which can apply the alias map and ask for
+    # clarification.
+    term = _extract_stock_term(user_message) if intent == "lookup" else None
+    if term:
+        try:
+            products = await notion.query_products(term)
+        except Exception as e:
+            logger.warning(f"Direct stock lookup failed, falling back to agent: {e}")
+            products = []
+        if products and _names_match(products, term):
+            reply = _format_stock(products)
+            _record_exchange(history, user_message, reply)
+            return reply
 
-    # Snapshot message count so we can rollback on failure
-    snapshot_len = len(messages)
+    await _compress(history)
 
-    messages.append({"role": "user", "content": user_message})
+    model = LOOKUP_MODEL if intent == "lookup" else MODEL
 
-    try:
-        # Agentic loop: keep going until Claude produces a final text response
-        while True:
-            response = await client.messages.create(
-                model=MODEL,
-                max_tokens=1024,
-                system=SYSTEM_PROMPT,
-                tools=TOOLS,
-                messages=messages,
-            )
+    # Build this turn separately and only commit it to history on success,
+    # so a failed tool loop never leaves orphaned tool_use/tool_result
+    # messages behind (and the history bound can't cut the turn mid-loop).
+    turn = [{"role": "user", "content": user_message}]
+    past = history.messages()
 
-            # If Claude wants to use tools, execute them and continue the loop
-            if response.stop_reason == "tool_use":
-                messages.append({"role": "assistant", "content": response.content})
+    # Agentic loop: keep going until Claude produces a final text response
+    while True:
+        response = await _CLIENT.messages.create(
+            model=model,
+            max_tokens=1024,
+            system=SYSTEM_BLOCKS,
+            tools=TOOLS,
+            messages=[*past, *turn],
+        )
 
-                tool_results = []
-                for block in response.content:
-                    if block.type == "tool_use":
-                        result = await _execute_tool(block.name, block.input, sender)
-                        tool_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": block.id,
-                            "content": json.dumps(result, ensure_ascii=False),
-                        })
+        # If Claude wants to use tools, execute them and continue the loop
+        if response.stop_reason == "tool_use":
+            turn.append({"role": "assistant", "content": response.content})
 
-                messages.append({"role": "user", "content": tool_results})
-                continue
+            # Run all tool calls from this turn concurrently; gather
+            # preserves order so results line up with their tool_use ids.
+            calls = [block for block in response.content if block.type == "tool_use"]
+            results = await asyncio.gather(
+                *[_execute_tool(block.name, block.input, sender) for block in calls]
+            )
+            tool_results = [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": block.id,
+                    "content": orjson.dumps(result).decode(),
+                }
+                for block, result in zip(calls, results)
+            ]
 
-            # Extract final text response and save to history
-            text_parts = [block.text for block in response.content if block.type == "text"]
-            reply = "\n".join(text_parts) if text_parts else "Sorry, I couldn't process that."
+            turn.append({"role": "user", "content": tool_results})
+            continue
 
-            messages.append({"role": "assistant", "content": reply})
-            _trim_conversation(sender)
+        # Extract final text response and save to history
+        text_parts = [block.text for block in response.content if block.type == "text"]
+        reply = "\n".join(text_parts) if text_parts else "Sorry, I couldn't process that."
 
-            return reply
+        turn.append({"role": "assistant", "content": reply})
+        history.extend(turn)
+        _drop_orphans(history)
 
-    except Exception:
-        # Rollback conversation to pre-request state so a failed tool loop
-        # doesn't leave orphaned tool_use/tool_result messages in history.
-        del messages[snapshot_len:]
-        raise
+        return reply
 
 
 async def _execute_tool(name: str, inputs: dict, sender: str = "default") -> dict:
@@ -315,6 +670,39 @@ async def _execute_tool(name: str, inputs: dict, sender: str = "default") -> dic
             )
             return {"success": True}
 
+        elif name == "record_sale":
+            # Read every input up front so a missing field fails before
+            # either write starts (and no coroutine is left unawaited).
+            page_id = inputs["page_id"]
+            new_stock = inputs["new_stock"]
+            product_name = inputs["product_name"]
+            quantity = inputs["quantity"]
+            unit_price = inputs["unit_price"]
+            sold_by = inputs.get("sold_by", sender)
+
+            # Stock update and sales log are independent once the product is
+            # known, so run both Notion writes concurrently.
+            stock_result, log_result = await asyncio.gather(
+                notion.update_stock(page_id, new_stock),
+                notion.log_sale(
+                    product_name=product_name,
+                    quantity=quantity,
+                    unit_price=unit_price,
+                    sold_by=sold_by,
+                ),
+                return_exceptions=True,
+            )
+            result = {
+                "stock_updated": not isinstance(stock_result, Exception),
+                "sale_logged": not isinstance(log_result, Exception),
+            }
+            errors = [str(r) for r in (stock_result, log_result) if isinstance(r, Exception)]
+            if errors:
+                result["error"] = "; ".join(errors)
+            else:
+                result["success"] = True
+            return result
+
         else:
             return {"error": f"Unknown tool: {name}"}
 
@@ -1,5 +1,6 @@
 import os
 import time
+import asyncio
 import logging
 from collections import OrderedDict
 from dotenv import load_dotenv
@@ -9,8 +10,10 @@ load_dotenv(override=True)
 from fastapi import BackgroundTasks, FastAPI, Request, Response
 from twilio.rest import Client as TwilioClient
 from twilio.request_validator import RequestValidator
+from twilio.twiml.messaging_response import MessagingResponse
 
 import agent
+import notion_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,6 +28,11 @@ app = FastAPI(title="Flame & Finish Inventory Bot")
 
 TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
 
+# "rest" (default): reply later via messages.create() — required for production
+# numbers behind a Messaging Service. "twiml": reply inline in the webhook
+# response, saving the outbound REST round-trip — works with the sandbox.
+TWILIO_REPLY_MODE = os.getenv("TWILIO_REPLY_MODE", "rest").strip().lower()
+
 # Authorized team numbers — comma-separated in .env
 _allowed_raw = os.getenv("ALLOWED_NUMBERS", "")
 ALLOWED_NUMBERS = {n.strip() for n in _allowed_raw.split(",") if n.strip()}
@@ -48,6 +56,17 @@ def _validate_twilio_signature(url: str, params: dict, signature: str) -> bool:
     return validator.validate(url, params, signature)
 
 
+@app.on_event("startup")
+async def startup():
+    app.state.sweeper = asyncio.create_task(agent.sweep_conversations())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.sweeper.cancel()
+    await notion_client.close()
+
+
 @app.get("/")
 async def health():
     return {"status": "ok", "service": "Flame & Finish Inventory Bot"}
@@ -60,11 +79,10 @@ EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
 async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     """Receive incoming WhatsApp messages from Twilio."""
     form_data = await request.form()
-    params = dict(form_data)
 
-    From = params.get("From", "")
-    Body = params.get("Body", "")
-    message_sid = params.get("MessageSid", "")
+    From = form_data.get("From", "")
+    Body = form_data.get("Body", "")
+    message_sid = form_data.get("MessageSid", "")
 
     # Deduplicate: Twilio may retry the webhook if our response is slow.
     # Ignore messages we've already seen.
@@ -85,7 +103,7 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     if os.getenv("VALIDATE_TWILIO_SIGNATURE", "false").lower() == "true":
         signature = request.headers.get("X-Twilio-Signature", "")
         url = str(request.url)
-        if not _validate_twilio_signature(url, params, signature):
+        if not _validate_twilio_signature(url, dict(form_data), signature):
             logger.warning(f"Invalid Twilio signature from {From}")
             return Response(status_code=403)
 
@@ -94,6 +112,11 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
         logger.warning(f"Unauthorized number: {From}")
         return Response(status_code=403)
 
+    if TWILIO_REPLY_MODE == "twiml":
+        twiml = MessagingResponse()
+        twiml.message(await _get_reply(Body, From))
+        return Response(content=str(twiml), media_type="text/xml")
+
     # Process in background so Twilio doesn't time out (15s limit)
     # Return empty TwiML immediately, then send reply via REST API when ready
     background_tasks.add_task(_process_and_reply, Body, From)
@@ -101,16 +124,24 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
     return Response(content=EMPTY_TWIML, media_type="text/xml")
 
 
-async def _process_and_reply(body: str, sender: str):
-    """Background task: process message through Claude and send reply via Twilio."""
+async def _get_reply(body: str, sender: str) -> str:
+    """Process a message through Claude, falling back to an apology on error."""
     try:
-        reply = await agent.handle_message(body, sender=sender)
+        return await agent.handle_message(body, sender=sender)
     except Exception as e:
         logger.error(f"Agent error: {e}", exc_info=True)
-        reply = "Sorry, something went wrong processing your message. Try again in a bit!"
+        return "Sorry, something went wrong processing your message. Try again in a bit!"
+
+
+async def _process_and_reply(body: str, sender: str):
+    """Background task: process message through Claude and send reply via Twilio."""
+    reply = await _get_reply(body, sender)
 
     try:
-        msg = _get_twilio_client().messages.create(
+        # The Twilio SDK is blocking — run it in a thread so the send doesn't
+        # stall the event loop (and every other in-flight webhook) meanwhile.
+        msg = await asyncio.to_thread(
+            _get_twilio_client().messages.create,
             body=reply,
             from_=TWILIO_WHATSAPP_NUMBER,
             to=sender,
@@ -122,4 +153,18 @@ async def _process_and_reply(body: str, sender: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)), reload=True)
+    port = int(os.getenv("PORT", 8000))
+    if os.getenv("ENV", "").lower() == "prod":
+        # Conversation memory, per-sender locks, webhook dedup and the lookup
+        # cache are all per-process — extra workers split a sender's history
+        # across processes, so keep WORKERS at 1 unless that state moves out.
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=port,
+            workers=int(os.getenv("WORKERS", 1)),
+            loop="uvloop",
+            http="httptools",
+        )
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
@@ -1,5 +1,9 @@
 import os
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
 import httpx
+import orjson
 
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 NOTION_DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
@@ -11,57 +15,110 @@ NOTION_HEADERS = {
     "Content-Type": "application/json",
 }
 
+# Shared client so every tool call reuses pooled (HTTP/2) connections to
+# api.notion.com instead of paying a fresh TLS handshake per request.
+_CLIENT = httpx.AsyncClient(
+    base_url=NOTION_BASE_URL,
+    headers=NOTION_HEADERS,
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+# Lookup cache: {normalized search term: (fetched_at, products)}, LRU-ordered.
+# Cleared on any write so stock/price changes are visible immediately.
+_PRODUCT_CACHE: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+_PRODUCT_CACHE_TTL = 60  # seconds to serve a cached lookup
+_PRODUCT_CACHE_MAX = 256  # max search terms to keep
+# Bumped on every clear; a lookup that raced a write skips storing its result.
+_product_cache_gen = 0
+
+# Notion property IDs for the _FIELDS we read, fetched once from the database
+# schema and sent as filter_properties so queries skip every other property.
+_PROPERTY_IDS: list[str] | None = None
+
+
+async def close():
+    """Close the shared Notion HTTP client. Call on app shutdown."""
+    await _CLIENT.aclose()
+
 
 async def query_products(search_term: str = "") -> list[dict]:
     """Query the Notion inventory database. Optionally filter by product name."""
-    url = f"{NOTION_BASE_URL}/databases/{NOTION_DATABASE_ID}/query"
+    search_term = (search_term or "").strip()
+    key = search_term.lower()
+    entry = _PRODUCT_CACHE.get(key)
+    if entry and time.time() - entry[0] < _PRODUCT_CACHE_TTL:
+        _PRODUCT_CACHE.move_to_end(key)
+        return entry[1]
+    gen = _product_cache_gen
 
-    payload = {}
+    payload = {
+        "page_size": 100,
+        "sorts": [{"property": "Product Name", "direction": "ascending"}],
+    }
     if search_term:
         payload["filter"] = {
             "property": "Product Name",
             "title": {"contains": search_term},
         }
+    params = [("filter_properties", prop_id) for prop_id in await _get_property_ids()]
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, headers=NOTION_HEADERS, json=payload)
+    # Follow the cursor so large result sets aren't silently cut at one page.
+    pages = []
+    while True:
+        resp = await _CLIENT.post(f"/databases/{NOTION_DATABASE_ID}/query", params=params, content=orjson.dumps(payload))
         resp.raise_for_status()
-        data = resp.json()
-
-    products = []
-    for page in data.get("results", []):
-        props = page["properties"]
-        products.append({
-            "id": page["id"],
-            "name": _get_title(props, "Product Name"),
-            "category": _get_select(props, "Category"),
-            "item_group": _get_rich_text(props, "Item Group"),
-            "subcategory": _get_rich_text(props, "Subcategory"),
-            "variant": _get_rich_text(props, "Color / Variant"),
-            "stock": _get_number(props, "Stock"),
-            "unit": _get_select(props, "Unit"),
-            "price": _get_number(props, "Unit Price (₱)"),
-            "landed_cost": _get_number(props, "Landed Cost (₱)"),
-            "min_sellable": _get_number(props, "Min Sellable (Floor)"),
-            "srp_1_5x": _get_number(props, "SRP @ 1.5x + VAT (₱)"),
-            "srp_2_0x": _get_number(props, "SRP @ 2.0x + VAT (₱)"),
-            "srp_3_0x": _get_number(props, "SRP @ 3.0x + VAT (₱)"),
-            "usd_per_pc": _get_number(props, "USD/pc (Ex Works)"),
-        })
+        data = orjson.loads(resp.content)
+        pages.extend(data.get("results", []))
+        if not data.get("has_more"):
+            break
+        payload["start_cursor"] = data["next_cursor"]
+
+    products = [
+        {"id": page["id"], **{name: _extract(page["properties"], prop, kind) for name, prop, kind in _FIELDS}}
+        for page in pages
+    ]
+
+    # Don't cache results fetched while a write was in flight — they may
+    # predate it and would serve stale stock for the whole TTL.
+    if gen == _product_cache_gen:
+        _PRODUCT_CACHE[key] = (time.time(), products)
+        _PRODUCT_CACHE.move_to_end(key)
+        while len(_PRODUCT_CACHE) > _PRODUCT_CACHE_MAX:
+            _PRODUCT_CACHE.popitem(last=False)
     return products
 
 
+def _clear_product_cache():
+    """Drop cached lookups after inventory changes."""
+    global _product_cache_gen
+    _product_cache_gen += 1
+    _PRODUCT_CACHE.clear()
+
+
+async def _get_property_ids() -> list[str]:
+    """Fetch (once) the Notion property IDs of the inventory fields we read."""
+    global _PROPERTY_IDS
+    if _PROPERTY_IDS is None:
+        resp = await _CLIENT.get(f"/databases/{NOTION_DATABASE_ID}")
+        resp.raise_for_status()
+        schema = orjson.loads(resp.content)["properties"]
+        # IDs come back URL-encoded; unquote so httpx doesn't encode them twice.
+        _PROPERTY_IDS = [unquote(schema[prop]["id"]) for _, prop, _ in _FIELDS if prop in schema]
+    return _PROPERTY_IDS
+
+
 async def update_stock(page_id: str, new_stock: int) -> bool:
     """Update the stock quantity for a product."""
-    url = f"{NOTION_BASE_URL}/pages/{page_id}"
     payload = {
         "properties": {
             "Stock": {"number": new_stock},
         }
     }
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(url, headers=NOTION_HEADERS, json=payload)
-        resp.raise_for_status()
+    resp = await _CLIENT.patch(f"/pages/{page_id}", content=orjson.dumps(payload))
+    resp.raise_for_status()
+    _clear_product_cache()
     return True
 
 
@@ -82,15 +139,14 @@ async def update_price(page_id: str, new_price: float, field: str = "unit_price"
     notion_property = PRICING_FIELDS.get(field)
     if not notion_property:
         raise ValueError(f"Unknown pricing field: {field}. Valid fields: {list(PRICING_FIELDS.keys())}")
-    url = f"{NOTION_BASE_URL}/pages/{page_id}"
     payload = {
         "properties": {
             notion_property: {"number": new_price},
         }
     }
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(url, headers=NOTION_HEADERS, json=payload)
-        resp.raise_for_status()
+    resp = await _CLIENT.patch(f"/pages/{page_id}", content=orjson.dumps(payload))
+    resp.raise_for_status()
+    _clear_product_cache()
     return True
 
 
@@ -103,7 +159,6 @@ async def log_sale(
     """Log a sale transaction to the Sales Log database."""
     from datetime import date
 
-    url = f"{NOTION_BASE_URL}/pages"
     payload = {
         "parent": {"database_id": NOTION_SALES_DB_ID},
         "properties": {
@@ -121,37 +176,45 @@ async def log_sale(
             },
         },
     }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, headers=NOTION_HEADERS, json=payload)
-        resp.raise_for_status()
+    resp = await _CLIENT.post("/pages", content=orjson.dumps(payload))
+    resp.raise_for_status()
+    _clear_product_cache()
     return True
 
 
 # --- Notion property helpers ---
 
-def _get_title(props: dict, key: str) -> str:
-    try:
-        return props[key]["title"][0]["plain_text"]
-    except (KeyError, IndexError):
-        return ""
-
-
-def _get_rich_text(props: dict, key: str) -> str:
-    try:
-        return props[key]["rich_text"][0]["plain_text"]
-    except (KeyError, IndexError):
-        return ""
-
-
-def _get_number(props: dict, key: str) -> float | None:
-    try:
-        return props[key]["number"]
-    except KeyError:
-        return None
+# Product fields returned by query_products: (output key, Notion property, property type)
+_FIELDS = [
+    ("name", "Product Name", "title"),
+    ("category", "Category", "select"),
+    ("item_group", "Item Group", "rich_text"),
+    ("subcategory", "Subcategory", "rich_text"),
+    ("variant", "Color / Variant", "rich_text"),
+    ("stock", "Stock", "number"),
+    ("unit", "Unit", "select"),
+    ("price", "Unit Price (₱)", "number"),
+    ("landed_cost", "Landed Cost (₱)", "number"),
+    ("min_sellable", "Min Sellable (Floor)", "number"),
+    ("srp_1_5x", "SRP @ 1.5x + VAT (₱)", "number"),
+    ("srp_2_0x", "SRP @ 2.0x + VAT (₱)", "number"),
+    ("srp_3_0x", "SRP @ 3.0x + VAT (₱)", "number"),
+    ("usd_per_pc", "USD/pc (Ex Works)", "number"),
+]
+
+# How to read each property type's value; missing/empty values fall back to
+# _DEFAULTS (None for numbers, "" for everything else).
+_EXTRACTORS = {
+    "title": lambda v: v[0]["plain_text"] if v else "",
+    "rich_text": lambda v: v[0]["plain_text"] if v else "",
+    "number": lambda v: v,
+    "select": lambda v: v["name"],
+}
+_DEFAULTS = {"number": None}
 
 
-def _get_select(props: dict, key: str) -> str:
-    try:
-        return props[key]["select"]["name"]
-    except (KeyError, TypeError):
-        return ""
+def _extract(props: dict, key: str, kind: str):
+    value = props.get(key, {}).get(kind)
+    if value is None:
+        return _DEFAULTS.get(kind, "")
+    return _EXTRACTORS[kind](value)